@@ -1,15 +1,34 @@
 import os
-import json
-import time
+import sys
+import queue
+import logging
+import logging.handlers
+import orjson
 import requests
-import websockets
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import websockets  # >= 14: connect() is the asyncio client with recv(decode=...)
 import asyncio
+import functools
 from dotenv import load_dotenv
-from openai import OpenAI
+
+try:
+    import uvloop  # optional: faster libuv-based event loop
+except ImportError:
+    uvloop = None
 
 load_dotenv()
 
-OPENAI_CLIENT = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Handlers only enqueue records; a listener thread does the actual stdout
+# writes so bursts of events don't block the websocket reader.
+_LOG_QUEUE = queue.Queue()
+_LOG_LISTENER = logging.handlers.QueueListener(
+    _LOG_QUEUE, logging.StreamHandler(sys.stdout))
+log = logging.getLogger("bot")
+log.setLevel(logging.INFO)
+log.propagate = False
+log.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+
 TWITCH_CLIENT_ID = os.getenv("TWITCH_CLIENT_ID")
 TWITCH_ACCESS_TOKEN = os.getenv("TWITCH_ACCESS_TOKEN")
 
@@ -19,55 +38,124 @@ EVENTSUB_TEST_WSS = "ws://127.0.0.1:8080/ws"
 
 USE_MOCK_EVENTSUB = 0
 SUBSCRIPTION_URL = "http://127.0.0.1:8080/eventsub/subscriptions" if USE_MOCK_EVENTSUB else f"{HELIX}/eventsub/subscriptions"
+CHAT_MESSAGES_URL = f"{HELIX}/chat/messages"
+CHAT_MESSAGE_MAX = 500
 WS_URL = EVENTSUB_TEST_WSS if USE_MOCK_EVENTSUB else EVENTSUB_WSS
-MOCK_UNSUPPORTED_SUBS = {
+MOCK_UNSUPPORTED_SUBS = frozenset({
     "channel.chat.message",
     # (often also unsupported in mocks)
     "channel.chat.notification",
     "channel.chat.message_delete",
     "channel.chat.clear",
     "channel.chat.clear_user_messages",
-}
+})
+
+# (sub_type, version, condition builder taking our user id) created on connect
+SUB_SPECS = [
+    # Chat messages
+    ("channel.chat.message", "1", lambda me: {"broadcaster_user_id": me, "user_id": me}),
+    # Subs/resubs
+    ("channel.subscribe", "1", lambda me: {"broadcaster_user_id": me}),
+    ("channel.subscription.message", "1", lambda me: {"broadcaster_user_id": me}),
+    # Gifted subs
+    ("channel.subscription.gift", "1", lambda me: {"broadcaster_user_id": me}),
+    # Bits
+    ("channel.cheer", "1", lambda me: {"broadcaster_user_id": me}),
+    # Raids (incoming)
+    ("channel.raid", "1", lambda me: {"to_broadcaster_user_id": me}),
+]
+
+# Matches the compact keepalive metadata as Twitch sends it. The quotes
+# would be escaped if this text appeared inside a chat message, so a
+# notification can't be mistaken for a keepalive.
+_KEEPALIVE_MARKER = b'"message_type":"session_keepalive"'
+
+# Welcome's keepalive_timeout_seconds (Twitch default 10) plus slack for jitter
+KEEPALIVE_TIMEOUT_DEFAULT = 10
+KEEPALIVE_SLACK = 5
+
+# Shared read-only fallback for missing JSON objects (never mutate)
+_EMPTY = {}
+
+# Dedupe window for "at least once" redeliveries; oldest ids are evicted past this
+SEEN_MAX = 50_000
 
-def twitch_headers():
-    return {
-        "Client-Id": TWITCH_CLIENT_ID,
-        "Authorization": f"Bearer {TWITCH_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
+
+class RingDedupe:
+    # Fixed-size FIFO of seen hashes plus a dict for O(1) membership;
+    # inserting overwrites (and forgets) the oldest slot, no reordering.
+    __slots__ = ("cap", "ring", "pos", "seen")
+
+    def __init__(self, cap: int):
+        self.cap = cap
+        self.ring = [None] * cap
+        self.pos = 0
+        self.seen = {}
+
+    # Record h; returns False if it was already in the window
+    def add(self, h: int) -> bool:
+        if h in self.seen:
+            return False
+        victim = self.ring[self.pos]
+        if victim is not None:
+            del self.seen[victim]
+        self.ring[self.pos] = h
+        self.seen[h] = self.pos
+        self.pos = (self.pos + 1) % self.cap
+        return True
+
+# One pooled keep-alive session for every Helix/OAuth call, so the startup
+# subscriptions and later chat replies reuse the same TLS connection.
+# Never create per-call sessions: that re-resolves DNS and redoes the TLS
+# handshake every request.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=8,
+        # Only GET (validate_token) is retried; retrying the subscription or
+        # chat POSTs could create duplicates. raise_on_status=False hands the
+        # final response back so raise_for_status() raises the usual HTTPError.
+        max_retries=Retry(total=3, backoff_factor=0.2,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=frozenset({"GET"}),
+                          raise_on_status=False),
+    ),
+)
+
+@functools.cache
+def get_openai():
+    # The openai SDK is slow to import and nothing needs it at startup,
+    # so import it and build the client on first use.
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+# Client id and token are static for the process, so build the headers once
+_HELIX_HEADERS = {
+    "Client-Id": TWITCH_CLIENT_ID,
+    "Authorization": f"Bearer {TWITCH_ACCESS_TOKEN}",
+    "Content-Type": "application/json",
+}
+_EVENTSUB_HEADERS = _HELIX_HEADERS if not USE_MOCK_EVENTSUB else {
+    # Twitch CLI mock endpoint: keep it simple
+    "Client-ID": TWITCH_CLIENT_ID or "mock",
+    "Content-Type": "application/json",
+}
+_VALIDATE_HEADERS = {"Authorization": f"OAuth {TWITCH_ACCESS_TOKEN}"}
 
 
 def validate_token():
-    r = requests.get(
+    r = SESSION.get(
         "https://id.twitch.tv/oauth2/validate",
-        headers={"Authorization": f"OAuth {TWITCH_ACCESS_TOKEN}"},
+        headers=_VALIDATE_HEADERS,
         timeout=20,
     )
     r.raise_for_status()
     return r.json()
 
 
-def eventsub_headers():
-    if USE_MOCK_EVENTSUB:
-        # Twitch CLI mock endpoint: keep it simple
-        return {
-            "Client-ID": TWITCH_CLIENT_ID or "mock",
-            "Content-Type": "application/json",
-        }
-    return {
-        "Client-Id": TWITCH_CLIENT_ID,
-        "Authorization": f"Bearer {TWITCH_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
-
-
-def safe_create_sub(session_id: str, sub_type: str, version: str, condition: dict):
-    if USE_MOCK_EVENTSUB and sub_type in MOCK_UNSUPPORTED_SUBS:
-        print(f"[mock] skipping unsupported sub: {sub_type}")
-        return None
-    return create_eventsub_subscription(session_id, sub_type, version, condition)
-
-
 def create_eventsub_subscription(session_id: str, sub_type: str, version: str, condition: dict):
     payload = {
         "type": sub_type,
@@ -76,10 +164,10 @@ def create_eventsub_subscription(session_id: str, sub_type: str, version: str, c
         "transport": {"method": "websocket", "session_id": session_id},
     }
 
-    r = requests.post(
+    r = SESSION.post(
         SUBSCRIPTION_URL,
-        headers=eventsub_headers(),
-        json=payload,  # <-- use json= instead of data=
+        headers=_EVENTSUB_HEADERS,  # already sets Content-Type: application/json
+        data=orjson.dumps(payload),
         timeout=20,
     )
     if not r.ok:
@@ -87,135 +175,218 @@ def create_eventsub_subscription(session_id: str, sub_type: str, version: str, c
             f"Create sub failed for {sub_type} ({r.status_code}): {r.text}")
     return r.json()
 
+
+# USE_MOCK_EVENTSUB is fixed at import, so pick the implementation once
+# instead of checking it on every subscription.
+if USE_MOCK_EVENTSUB:
+    def safe_create_sub(session_id: str, sub_type: str, version: str, condition: dict):
+        if sub_type in MOCK_UNSUPPORTED_SUBS:
+            log.info("[mock] skipping unsupported sub: %s", sub_type)
+            return None
+        return create_eventsub_subscription(session_id, sub_type, version, condition)
+else:
+    safe_create_sub = create_eventsub_subscription
+
+
 def send_chat_message(broadcaster_id: str, sender_id: str, message: str):
     payload = {
         "broadcaster_id": broadcaster_id,
         "sender_id": sender_id,
         # message limit is 500 chars :contentReference[oaicite:20]{index=20}
-        "message": message[:500],
+        "message": message[:CHAT_MESSAGE_MAX],
     }
-    r = requests.post(f"{HELIX}/chat/messages",
-                      headers=twitch_headers(), data=json.dumps(payload), timeout=20)
+    r = SESSION.post(CHAT_MESSAGES_URL,
+                     headers=_HELIX_HEADERS, data=orjson.dumps(payload), timeout=20)
     r.raise_for_status()
     return r.json()
 
 
+# Keep references so fire-and-forget sends aren't garbage collected mid-flight
+_BACKGROUND_TASKS = set()
+
+
+def _on_send_done(task: asyncio.Task):
+    _BACKGROUND_TASKS.discard(task)
+    if task.cancelled():
+        return
+    # Nobody awaits these tasks, so surface failures through the bot's log
+    exc = task.exception()
+    if exc is not None:
+        log.error("Chat send failed: %s", exc, exc_info=exc)
+
+
+def send_chat_message_nowait(broadcaster_id: str, sender_id: str, message: str):
+    # Run the blocking send on a worker thread so the recv loop never waits on it
+    task = asyncio.create_task(
+        asyncio.to_thread(send_chat_message, broadcaster_id, sender_id, message))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_send_done)
+    return task
+
+
+def _ping_reply(me_id: str, send):
+    send(broadcaster_id=me_id, sender_id=me_id, message="pong (via Helix)")
+
+
+# Normalized (stripped, lowercased) chat text -> command(me_id, send)
+_COMMANDS = {
+    "!ping": _ping_reply,
+}
+
+
+def _on_chat(event: dict, me_id: str, send):
+    chatter = event["chatter_user_login"]
+    text = event["message"]["text"]
+
+    log.info("%s: %s", chatter, text)
+
+    # Most chat isn't a command: only strip/lower text that can start with "!"
+    if not text or (text[0] != "!" and not text[0].isspace()):
+        return
+    command = _COMMANDS.get(text.strip().lower())
+    if command is not None:
+        command(me_id, send)
+
+
+def _on_sub(event: dict, me_id: str, send):
+    user = event.get("user_login")
+    tier = event.get("tier")
+    is_gift = event.get("is_gift")
+    log.info("Sub: %s (tier=%s, gift=%s)", user, tier, is_gift)
+
+
+def _on_resub(event: dict, me_id: str, send):
+    user = event.get("user_login")
+    tier = event.get("tier")
+    months = event.get("cumulative_months")
+    msg_text = (event.get("message") or _EMPTY).get("text", "")
+    log.info("Resub: %s (tier=%s, months=%s) %s", user, tier, months, msg_text)
+
+
+def _on_gift(event: dict, me_id: str, send):
+    gifter = event.get("user_login")
+    total = event.get("total")
+    tier = event.get("tier")
+    log.info("Gifted subs: %s (tier=%s, total=%s)", gifter, tier, total)
+
+
+def _on_cheer(event: dict, me_id: str, send):
+    user = event.get("user_login")
+    bits = event.get("bits")
+    msg_text = event.get("message", "")
+    log.info("Bits: %s (%s) %s", user, bits, msg_text)
+
+
+def _on_raid(event: dict, me_id: str, send):
+    raider = event.get("from_broadcaster_user_login")
+    viewers = event.get("viewers")
+    log.info("Raid: %s with %s viewers", raider, viewers)
+
+
+# subscription_type -> handler(event, me_id, send)
+HANDLERS = {
+    "channel.chat.message": _on_chat,
+    "channel.subscribe": _on_sub,
+    "channel.subscription.message": _on_resub,
+    "channel.subscription.gift": _on_gift,
+    "channel.cheer": _on_cheer,
+    "channel.raid": _on_raid,
+}
+
+
 async def run():
     # returns user_id, scopes, expires_in, etc. :contentReference[oaicite:21]{index=21}
     token_info = validate_token()
     me_id = token_info["user_id"]
 
-    seen_message_ids = set()
+    # Hashes of the last SEEN_MAX message_ids
+    seen_message_ids = RingDedupe(SEEN_MAX)
 
-    async with websockets.connect(WS_URL) as ws:
+    # Frames are small JSON and Twitch drives keepalives itself, so skip
+    # permessage-deflate and client-side pings; the recv loop below enforces
+    # the keepalive window instead.
+    async with websockets.connect(
+        WS_URL,
+        compression=None,
+        max_size=1 << 20,
+        ping_interval=None,
+        ping_timeout=None,
+        close_timeout=2,
+    ) as ws:
         # Wait for Welcome -> contains session id, and you have ~10s to subscribe by default :contentReference[oaicite:22]{index=22}
-        welcome_raw = await ws.recv()
-        welcome = json.loads(welcome_raw)
-        session_id = welcome["payload"]["session"]["id"]
-
-        # Subscribe to chat messages
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.chat.message",
-            version="1",
-            condition={"broadcaster_user_id": me_id, "user_id": me_id},
-        )
-        # Subscribe to subs/resubs
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.subscribe",
-            version="1",
-            condition={"broadcaster_user_id": me_id},
-        )
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.subscription.message",
-            version="1",
-            condition={"broadcaster_user_id": me_id},
-        )
-        # Subscribe to gifted subs
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.subscription.gift",
-            version="1",
-            condition={"broadcaster_user_id": me_id},
-        )
-        # Subscribe to bits
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.cheer",
-            version="1",
-            condition={"broadcaster_user_id": me_id},
-        )
-        # Subscribe to raids (incoming)
-        safe_create_sub(
-            session_id=session_id,
-            sub_type="channel.raid",
-            version="1",
-            condition={"to_broadcaster_user_id": me_id},
+        welcome_raw = await ws.recv(decode=False)
+        welcome = orjson.loads(welcome_raw)
+        session = welcome["payload"]["session"]
+        session_id = session["id"]
+        # Twitch sends something (at worst a keepalive) at least this often;
+        # silence beyond it means the link is dead or half-open
+        recv_timeout = (session.get("keepalive_timeout_seconds")
+                        or KEEPALIVE_TIMEOUT_DEFAULT) + KEEPALIVE_SLACK
+
+        # Create all subscriptions concurrently so setup fits in the Welcome window.
+        # Each call blocks on the pooled Session, so run them on worker threads.
+        results = await asyncio.gather(
+            *[asyncio.to_thread(safe_create_sub, session_id, sub_type, version, condition(me_id))
+              for sub_type, version, condition in SUB_SPECS],
+            return_exceptions=True,
         )
+        # Let every request finish, then fail like before if any of them did
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
-        print("Connected. Listening for chat messages, subs, bits, and raids...")
+        log.info("Connected. Listening for chat messages, subs, bits, and raids...")
 
         while True:
-            raw = await ws.recv()
-            msg = json.loads(raw)
+            try:
+                async with asyncio.timeout(recv_timeout):
+                    # decode=False keeps text frames as raw UTF-8 bytes for orjson
+                    raw = await ws.recv(decode=False)
+            except websockets.ConnectionClosedOK:
+                log.info("EventSub connection closed by server")
+                return
+            except TimeoutError:
+                raise RuntimeError(
+                    f"No EventSub message for {recv_timeout}s; connection presumed dead") from None
+
+            # Keepalives are the most common frame; drop them without parsing
+            if _KEEPALIVE_MARKER in raw:
+                continue
+            msg = orjson.loads(raw)
 
-            mtype = msg.get("metadata", {}).get("message_type")
+            # EventSub frames always carry metadata.message_type; skip the rare
+            # malformed one instead of paying for .get fallbacks on every frame
+            try:
+                meta = msg["metadata"]
+                mtype = meta["message_type"]
+            except KeyError:
+                log.warning("Dropping EventSub frame without metadata.message_type: %.200r", raw)
+                continue
 
             # Keepalive just means connection is healthy :contentReference[oaicite:23]{index=23}
             if mtype == "session_keepalive":
                 continue
 
             # Notifications are delivered "at least once" -> dedupe by message_id :contentReference[oaicite:24]{index=24}
-            mid = msg.get("metadata", {}).get("message_id")
-            if mid and mid in seen_message_ids:
+            mid = meta.get("message_id")
+            if mid and not seen_message_ids.add(hash(mid)):
                 continue
-            if mid:
-                seen_message_ids.add(mid)
 
             if mtype == "notification":
-                sub_type = msg.get("metadata", {}).get("subscription_type")
-                event = msg["payload"]["event"]
-
-                if sub_type == "channel.chat.message":
-                    chatter = event["chatter_user_login"]
-                    text = event["message"]["text"]
-
-                    print(f"{chatter}: {text}")
-
-                    if text.strip().lower() == "!ping":
-                        send_chat_message(
-                            broadcaster_id=me_id, sender_id=me_id, message="pong (via Helix)")
-                elif sub_type == "channel.subscribe":
-                    user = event.get("user_login")
-                    tier = event.get("tier")
-                    is_gift = event.get("is_gift")
-                    print(f"Sub: {user} (tier={tier}, gift={is_gift})")
-                elif sub_type == "channel.subscription.message":
-                    user = event.get("user_login")
-                    tier = event.get("tier")
-                    months = event.get("cumulative_months")
-                    msg_text = event.get("message", {}).get("text", "")
-                    print(f"Resub: {user} (tier={tier}, months={months}) {msg_text}")
-                elif sub_type == "channel.subscription.gift":
-                    gifter = event.get("user_login")
-                    total = event.get("total")
-                    tier = event.get("tier")
-                    print(f"Gifted subs: {gifter} (tier={tier}, total={total})")
-                elif sub_type == "channel.cheer":
-                    user = event.get("user_login")
-                    bits = event.get("bits")
-                    msg_text = event.get("message", "")
-                    print(f"Bits: {user} ({bits}) {msg_text}")
-                elif sub_type == "channel.raid":
-                    raider = event.get("from_broadcaster_user_login")
-                    viewers = event.get("viewers")
-                    print(f"Raid: {raider} with {viewers} viewers")
-
-asyncio.run(run())
-
-# resp = OPENAI_CLIENT.responses.create(
-#     model="gpt-5-nano-2025-08-07",
-    
-# )
+                sub_type = meta.get("subscription_type")
+                payload = msg.get("payload") or _EMPTY
+                event = payload.get("event") or _EMPTY
+
+                handler = HANDLERS.get(sub_type)
+                if handler is not None:
+                    handler(event, me_id, send_chat_message_nowait)
+
+_LOG_LISTENER.start()
+try:
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+        runner.run(run())
+finally:
+    # The pooled Session lives exactly as long as the bot; close its sockets
+    SESSION.close()
+    # Flush anything still queued before exiting
+    _LOG_LISTENER.stop()